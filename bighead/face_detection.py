@@ -1,15 +1,40 @@
+import math
 import os
 
-from tempfile import mkstemp
-from typing import Optional
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict
+from io import BytesIO
+from threading import Lock
+from typing import Any, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
 
 import dlib
 import numpy as np
 import requests
 
-_FACE_DETECTOR = dlib.get_frontal_face_detector()
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+# Path to mmod_human_face_detector.dat, for the CNN detector when CUDA is available.
+_CNN_MODEL_PATH = os.environ.get("BIGHEAD_CNN_MODEL")
+_USE_CNN = bool(_CNN_MODEL_PATH) and dlib.DLIB_USE_CUDA
+if _USE_CNN:
+    _FACE_DETECTOR = dlib.cnn_face_detection_model_v1(_CNN_MODEL_PATH)
+else:
+    _FACE_DETECTOR = dlib.get_frontal_face_detector()
+# dlib's detectors are not safe to call from several threads at once.
+_DETECTOR_LOCK = Lock()
 _MAX_PIXELS = 1024 ** 2
 HTTPError = requests.HTTPError
+# Connections are reused across URL loads to skip repeated TCP and TLS handshakes.
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_maxsize=32))
+_SESSION.mount("https://", HTTPAdapter(pool_maxsize=32))
+_TIMEOUT = 10
+# Images loaded from URLs, least recently used first, up to a total size in bytes.
+_URL_CACHE: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_URL_CACHE_BYTES = 256 * 1024 ** 2
+_URL_CACHE_LOCK = Lock()
 
 
 class InvalidImage(Exception):
@@ -17,13 +42,17 @@ class InvalidImage(Exception):
     Raised when an image is of an invalid format.
 
     Attributes:
-        error (RuntimeError): error from dlib.load_rgb_image.
+        error (Exception): error from loading or validating the image.
     """
 
-    def __init__(self, error: RuntimeError) -> None:
+    def __init__(self, error: Exception) -> None:
         self.error = error
         super().__init__(*error.args)
 
+    def __reduce__(self) -> Tuple[Any, ...]:
+        # Exceptions are unpickled from their args by default, which doesn't work here.
+        return InvalidImage, (self.error,)
+
 
 class TooLarge(Exception):
     """
@@ -39,6 +68,10 @@ class TooLarge(Exception):
         self.msg = f"Image is too large: {self.dims}"
         super().__init__(self.msg)
 
+    def __reduce__(self) -> Tuple[Any, ...]:
+        # Only the dimensions are needed, so an empty image with the same shape will do.
+        return TooLarge, (np.empty((*self.dims, 0)),)
+
 
 def find_biggest_face(
     *,
@@ -47,6 +80,7 @@ def find_biggest_face(
     path: Optional[str] = None,
     url: Optional[str] = None,
     upsample: int = 0,
+    downscale: bool = False,
 ) -> Optional[dlib.rectangle]:
     """
     Get the bounding box for the biggest face in the image.
@@ -55,22 +89,26 @@ def find_biggest_face(
     Kwargs:
         data: raw image data.
         image: an existing image array.
+            It must be uint8 RGB (H, W, 3) or grayscale (H, W).
+            Non-contiguous arrays are copied.
         path: path to image file.
         url: URL pointing to image file.
+            Images are cached (read-only) by URL, unless it has a no-cache query
+            parameter or the image is too large.
         upsample: number of times to upsample the image.
+        downscale: shrink images that are too large instead of rejecting them.
     Returns:
         bounding box around the biggest face, or None if no faces were found.
     Raises:
         FileNotFoundError: when the path does not point to a file.
         HTTPError: when the HTTP request fails.
         InvalidImage: when the input image is invalid.
-        TooLarge: when the input image is too large.
+        TooLarge: when the input image is too large and downscale is not set.
         ValueError: when you fail to specify an image source.
     """
     to_search = _load_image(data=data, image=image, path=path, url=url)
-    if _is_too_large(to_search):
-        raise TooLarge(to_search)
-    return _get_bounding_box(to_search, upsample)
+    box, _ = _detect(to_search, upsample, downscale, crop=False)
+    return box
 
 
 def extract_biggest_face(
@@ -80,6 +118,7 @@ def extract_biggest_face(
     path: Optional[str] = None,
     url: Optional[str] = None,
     upsample: int = 0,
+    downscale: bool = False,
 ) -> Optional[np.ndarray]:
     """
     Find and crop out the biggest face in the image.
@@ -88,25 +127,71 @@ def extract_biggest_face(
     Kwargs:
         data: raw image data.
         image: an existing image array.
+            It must be uint8 RGB (H, W, 3) or grayscale (H, W).
+            Non-contiguous arrays are copied.
         path: path to image file.
         url: URL pointing to image file.
+            Images are cached (read-only) by URL, unless it has a no-cache query
+            parameter or the image is too large.
         upsample: number of times to upsample the image.
+        downscale: shrink images that are too large instead of rejecting them.
+            The face is still cropped from the original image.
     Returns:
         cropped image containing the biggest face, or None if no faces were found.
     Raises:
         FileNotFoundError: when the path does not point to a file.
         HTTPError: when the HTTP request fails.
         InvalidImage: when the input image is invalid.
-        TooLarge: when the input image is too large.
+        TooLarge: when the input image is too large and downscale is not set.
         ValueError: when you fail to specify an image source.
     """
     to_search = _load_image(data=data, image=image, path=path, url=url)
-    if _is_too_large(to_search):
-        raise TooLarge(to_search)
-    box = _get_bounding_box(to_search, upsample)
-    if not box:
-        return None
-    return _crop(to_search, box)
+    _, face = _detect(to_search, upsample, downscale, crop=True)
+    return face
+
+
+def create_executor() -> Executor:
+    """
+    Create an executor for running detections in parallel.
+    Normally, this is a pool of worker processes, one per CPU core.
+    With the CNN detector, it's a single thread instead, since CUDA state doesn't
+    survive forking and the GPU does the parallel work anyway.
+
+    Returns:
+        the new executor.
+    """
+    if _USE_CNN:
+        return ThreadPoolExecutor(max_workers=1)
+    return ProcessPoolExecutor(max_workers=os.cpu_count())
+
+
+def _detect(
+    image: np.ndarray, upsample: int, downscale: bool, crop: bool
+) -> Tuple[Optional[dlib.rectangle], Optional[np.ndarray]]:
+    """
+    Find the biggest face in the image, and optionally crop it out.
+
+    Args:
+        image: input image.
+        upsample: number of times to upsample the image.
+        downscale: shrink the image if it's too large instead of rejecting it.
+        crop: whether or not to crop out the face.
+    Returns:
+        bounding box around the biggest face and, if requested, the cropped face.
+        Both are None if no faces were found.
+    Raises:
+        TooLarge: when the input image is too large and downscale is not set.
+    """
+    height, width = image.shape[:2]
+    if height * width <= _MAX_PIXELS:  # Inlined _is_too_large.
+        box = _get_bounding_box(image, upsample)
+    elif downscale:
+        box = _get_downscaled_bounding_box(image, upsample)
+    else:
+        raise TooLarge(image)
+    if not box or not crop:
+        return box, None
+    return box, _crop(image, box)
 
 
 def _load_image(
@@ -123,6 +208,8 @@ def _load_image(
     Kwargs:
         data: raw image data.
         image: an existing image array.
+            It must be uint8 RGB (H, W, 3) or grayscale (H, W).
+            Non-contiguous arrays are copied.
         path: path to image file.
         url: URL pointing to image file.
         upsample: number of times to upsample the image.
@@ -137,7 +224,11 @@ def _load_image(
     if data is not None:
         return _load_from_data(data)
     elif image is not None:
-        return image
+        # Casting other types to uint8 would silently mangle pixel values.
+        if image.dtype != np.uint8:
+            error = ValueError(f"Image must be uint8, not {image.dtype}")
+            raise InvalidImage(error)
+        return np.ascontiguousarray(image)  # dlib would copy it otherwise.
     elif path is not None:
         return _load_from_path(path)
     elif url is not None:
@@ -155,16 +246,17 @@ def _load_from_data(data: bytes) -> np.ndarray:
     Returns:
         the loaded image.
     Raises:
-        InvalidImage: when the image is of an invalid format.
+        InvalidImage: when the image is of an invalid format, or is so large that
+            Pillow refuses to decode it.
     """
-    # TODO: Load image from memory (https://github.com/davisking/dlib/issues/818).
-    _, path = mkstemp()
-    with open(path, "wb") as f:
-        f.write(data)
     try:
-        return _load_from_path(path)
-    finally:
-        os.remove(path)
+        with Image.open(BytesIO(data)) as img:
+            # np.array rather than np.asarray, which would be read-only.
+            return np.array(img.convert("RGB"))
+    # OSError includes PIL.UnidentifiedImageError, but DecompressionBombError is
+    # raised before any dimensions are available, so it can't become a TooLarge.
+    except (OSError, Image.DecompressionBombError) as e:
+        raise InvalidImage(e)
 
 
 def _load_from_path(path: str) -> np.ndarray:
@@ -190,6 +282,8 @@ def _load_from_path(path: str) -> np.ndarray:
 def _load_from_url(url: str) -> np.ndarray:
     """
     Load an image from a URL.
+    Images within the pixel limit are cached and read-only, unless the URL has a
+    no-cache query parameter.
 
     Args:
         url: URL pointing to image file.
@@ -199,7 +293,53 @@ def _load_from_url(url: str) -> np.ndarray:
         InvalidImage:when the image is of an invalid format.
         HTTPError: when the HTTP request fails.
     """
-    resp = requests.get(url)
+    if "no-cache" in parse_qs(urlparse(url).query, keep_blank_values=True):
+        return _download_image(url)
+    with _URL_CACHE_LOCK:
+        image = _URL_CACHE.get(url)
+        if image is not None:
+            _URL_CACHE.move_to_end(url)
+            return image
+    image = _download_image(url)
+    height, width = image.shape[:2]
+    # Images that are too large would take up most of the cache for little benefit.
+    if height * width <= _MAX_PIXELS:
+        _cache_image(url, image)
+    return image
+
+
+def _cache_image(url: str, image: np.ndarray) -> None:
+    """
+    Add an image to the URL cache, evicting the least recently used images to make
+    room for it.
+    The image is made read-only, since it's shared between callers.
+
+    Args:
+        url: URL that the image was loaded from.
+        image: the loaded image.
+    """
+    image.setflags(write=False)
+    with _URL_CACHE_LOCK:
+        _URL_CACHE[url] = image
+        size = sum(cached.nbytes for cached in _URL_CACHE.values())
+        while size > _URL_CACHE_BYTES:
+            _, evicted = _URL_CACHE.popitem(last=False)
+            size -= evicted.nbytes
+
+
+def _download_image(url: str) -> np.ndarray:
+    """
+    Download and decode an image from a URL.
+
+    Args:
+        url: URL pointing to image file.
+    Returns:
+        the loaded image.
+    Raises:
+        InvalidImage:when the image is of an invalid format.
+        HTTPError: when the HTTP request fails.
+    """
+    resp = _SESSION.get(url, timeout=_TIMEOUT)
     resp.raise_for_status()
     return _load_from_data(resp.content)
 
@@ -222,6 +362,8 @@ def _is_too_large(image: np.ndarray) -> bool:
 def _get_bounding_box(image: np.ndarray, upsample: int) -> Optional[dlib.rectangle]:
     """
     Find the biggest face in the image.
+    Only one detection runs at a time per process, so parallelize with processes
+    rather than threads (bighead.web does this with a process pool).
 
     Args:
         image: input image.
@@ -229,15 +371,55 @@ def _get_bounding_box(image: np.ndarray, upsample: int) -> Optional[dlib.rectang
     Returns:
         bounding box around the biggest face, or None if no faces were found.
     """
-    rects = _FACE_DETECTOR(image, upsample)
-    if not rects:  # No detections.
+    with _DETECTOR_LOCK:
+        rects = _FACE_DETECTOR(image, upsample)
+    if _USE_CNN:
+        rects = [d.rect for d in rects]  # Unwrap the mmod_rectangles.
+    best = None
+    best_area = -1
+    for rect in rects:  # A plain loop avoids a lambda call per detection.
+        area = rect.area()
+        if area > best_area:
+            best, best_area = rect, area
+    return best
+
+
+def _get_downscaled_bounding_box(
+    image: np.ndarray, upsample: int
+) -> Optional[dlib.rectangle]:
+    """
+    Find the biggest face in an image that is too large to search directly.
+    The image is shrunk to fit within the pixel limit before detection.
+
+    Args:
+        image: input image.
+        upsample: number of times to upsample the image.
+    Returns:
+        bounding box around the biggest face in the coordinates of the original image,
+        or None if no faces were found.
+    """
+    height, width = image.shape[:2]
+    scale = math.sqrt(_MAX_PIXELS / (height * width))
+    # Very elongated images would otherwise shrink to nothing along one side.
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    small = np.asarray(Image.fromarray(image).resize(size, Image.BOX))
+    rect = _get_bounding_box(small, upsample)
+    if not rect:
         return None
-    return max(rects, key=lambda r: r.area())
+    # Rounding makes the actual scale factors differ between the axes.
+    scale_x = width / size[0]
+    scale_y = height / size[1]
+    return dlib.rectangle(
+        int(rect.left() * scale_x),
+        int(rect.top() * scale_y),
+        int(rect.right() * scale_x),
+        int(rect.bottom() * scale_y),
+    )
 
 
 def _crop(image: np.ndarray, rect: dlib.rectangle) -> np.ndarray:
     """
-    Crop an image to the given rectangle.
+    Crop an image to the given rectangle, clamped to the image bounds.
     The input is not modified.
 
     Args:
@@ -246,8 +428,28 @@ def _crop(image: np.ndarray, rect: dlib.rectangle) -> np.ndarray:
     Returns:
         the cropped image.
     """
-    top = rect.top()
-    bottom = rect.bottom()
-    left = rect.left()
-    right = rect.right()
+    height, width = image.shape[:2]
+    # Negative coordinates (possible for faces on the border) would wrap around.
+    top = max(0, rect.top())
+    bottom = min(height, rect.bottom())
+    left = max(0, rect.left())
+    right = min(width, rect.right())
     return image[top:bottom, left:right]
+
+
+def _warm_up() -> None:
+    """
+    Pay one-time startup costs at import instead of on the first request.
+    This runs a throwaway detection (which initializes CUDA for the CNN detector),
+    and connects to the URL in BIGHEAD_WARMUP_URL, if set.
+    """
+    _FACE_DETECTOR(np.zeros((320, 240, 3), np.uint8), 0)
+    url = os.environ.get("BIGHEAD_WARMUP_URL")
+    if url:
+        try:
+            _SESSION.head(url, timeout=_TIMEOUT)
+        except requests.RequestException:
+            pass  # This is only an optimization, so it shouldn't break the import.
+
+
+_warm_up()
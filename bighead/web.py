@@ -1,18 +1,29 @@
 import logging
 
+from concurrent.futures import Executor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
 from typing import Dict, Optional, Tuple
 
 import dlib
 
 from flask import Flask, request
 from requests import codes
-from werkzeug.exceptions import InternalServerError, MethodNotAllowed, NotFound
+from werkzeug.exceptions import (
+    InternalServerError,
+    MethodNotAllowed,
+    NotFound,
+    RequestEntityTooLarge,
+)
 
-from .face_detection import InvalidImage, TooLarge, find_biggest_face
+from .face_detection import InvalidImage, TooLarge, create_executor, find_biggest_face
 
 app = Flask(__name__)
 app.logger.setLevel(logging.DEBUG)
+app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 ** 2
 JSON = Tuple[Dict[str, object], int]
+_POOL = create_executor()
+_POOL_LOCK = Lock()
 
 
 @app.errorhandler(NotFound)
@@ -25,6 +36,11 @@ def method_not_allowed(e: MethodNotAllowed) -> JSON:
     return {"error": "Method not allowed"}, codes.method_not_allowed
 
 
+@app.errorhandler(RequestEntityTooLarge)
+def request_entity_too_large(e: RequestEntityTooLarge) -> JSON:
+    return {"error": "Request data is too large"}, codes.request_entity_too_large
+
+
 @app.errorhandler(InternalServerError)
 def internal_server_error(e: InternalServerError) -> JSON:
     # Flask already displays the error, we don't need to do anything.
@@ -62,9 +78,21 @@ def _preprocess_request() -> Tuple[bytes, int]:
     Returns:
         the raw image data and the upsample count in a tuple.
     Raises:
+        RequestEntityTooLarge: when the request data exceeds MAX_CONTENT_LENGTH.
         ValueError: when the request is invalid.
     """
-    if not request.data:
+    length = request.content_length
+    limit = app.config["MAX_CONTENT_LENGTH"]
+    if length is not None and length > limit:
+        app.logger.warning(f"Request data is too large: {length}")
+        raise RequestEntityTooLarge()
+    # Read the body directly rather than through request.data, which caches it.
+    # Chunked uploads have no length, so read one byte past the limit to spot excess.
+    data = request.stream.read(limit + 1 if length is None else length)
+    if len(data) > limit:
+        app.logger.warning("Chunked request data is too large")
+        raise RequestEntityTooLarge()
+    if not data:
         app.logger.warning("Request data is missing")
         raise ValueError("No data found, make sure to set Content-Type")
     upsample_arg = request.args.get("upsample", "0")
@@ -77,7 +105,7 @@ def _preprocess_request() -> Tuple[bytes, int]:
         app.logger.warning("Negative number provided for upsample: {upsample}")
         raise ValueError("Value for upsample argument must be nonnegative")
     else:
-        return request.data, upsample
+        return data, upsample
 
 
 def _error(message: str, status: int) -> JSON:
@@ -86,7 +114,7 @@ def _error(message: str, status: int) -> JSON:
 
     Args:
         message: the error message.
-        status: the 4xx HTTP status code.
+        status: the 4xx or 5xx HTTP status code.
     Returns:
         the JSON HTTP response.
     """
@@ -116,6 +144,7 @@ def _success(rect: Optional[dlib.rectangle]) -> JSON:
 def _detect(data: bytes, upsample: int) -> JSON:
     """
     Attempts largest face detection with the given data.
+    The detection itself is run in the pool, which is replaced if a worker dies.
 
     Args:
         data: raw image data.
@@ -123,8 +152,13 @@ def _detect(data: bytes, upsample: int) -> JSON:
     Returns:
         the HTTP response, whose status code varies with the detection outcome.
     """
+    pool = _POOL
     try:
-        box = find_biggest_face(data=data, upsample=upsample)
+        box = pool.submit(find_biggest_face, data=data, upsample=upsample).result()
+    except BrokenProcessPool:
+        app.logger.error("A detection worker died, restarting the pool")
+        _restart_pool(pool)
+        return _error("Face detection failed", codes.server_error)
     except InvalidImage as e:
         app.logger.warning(f"Invalid image: {e}")
         return _error("The image is invalid", codes.unprocessable)
@@ -136,3 +170,18 @@ def _detect(data: bytes, upsample: int) -> JSON:
     else:
         app.logger.info("Did not find a face")
     return _success(box)
+
+
+def _restart_pool(broken: Executor) -> None:
+    """
+    Replace a broken pool, which would otherwise fail every later submission.
+    Requests that fail concurrently only trigger one replacement.
+
+    Args:
+        broken: the pool that broke.
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is broken:
+            _POOL = create_executor()
+            broken.shutdown(wait=False)
@@ -27,6 +27,7 @@ setup(
         "dlib==19.*,>=19.19.0",
         "flask==1.*,>=1.1.1",
         "numpy==1.*,>=1.18.1",
+        "pillow==7.*,>=7.0.0",
         "requests==2.*,>=2.23.0",
     ],
     extras_require={
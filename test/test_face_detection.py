@@ -1,10 +1,14 @@
 import os.path
+import pickle
 
-from unittest.mock import patch, sentinel
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from unittest.mock import Mock, patch, sentinel
 
 import dlib
 import numpy as np
 import pytest
+import requests
 
 from bighead import face_detection as fd
 
@@ -25,16 +29,60 @@ def test_find_biggest_face():
     assert box.left() > 300  # Ensure that we have the bigger face on the right.
     with pytest.raises(fd.TooLarge):
         fd.find_biggest_face(path=BIG_PATH)
+    assert fd.find_biggest_face(path=BIG_PATH, downscale=True) is None
 
 
 def test_extract_biggest_face():
     assert fd.extract_biggest_face(path=ZERO_PATH) is None
     face = fd.extract_biggest_face(path=ONE_PATH)
     assert isinstance(face, np.ndarray)
+    face = fd.extract_biggest_face(data=ONE_BYTES)
+    assert isinstance(face, np.ndarray)
+    assert face.flags.writeable
     face = fd.extract_biggest_face(path=TWO_PATH)
     assert isinstance(face, np.ndarray)
     with pytest.raises(fd.TooLarge):
         fd.extract_biggest_face(path=BIG_PATH)
+    assert fd.extract_biggest_face(path=BIG_PATH, downscale=True) is None
+
+
+def test_create_executor():
+    executor = fd.create_executor()
+    assert isinstance(executor, ProcessPoolExecutor)
+    executor.shutdown()
+    with patch("bighead.face_detection._USE_CNN", True):
+        executor = fd.create_executor()
+    assert isinstance(executor, ThreadPoolExecutor)
+    executor.shutdown()
+
+
+def test_detect():
+    image = fd._load_from_path(ONE_PATH)
+    box, face = fd._detect(image, 0, False, crop=False)
+    assert isinstance(box, dlib.rectangle)
+    assert face is None
+    box, face = fd._detect(image, 0, False, crop=True)
+    assert isinstance(box, dlib.rectangle)
+    assert np.array_equal(face, fd._crop(image, box))
+    assert fd._detect(fd._load_from_path(ZERO_PATH), 0, False, crop=True) == (
+        None,
+        None,
+    )
+    big = fd._load_from_path(BIG_PATH)
+    with pytest.raises(fd.TooLarge):
+        fd._detect(big, 0, False, crop=False)
+    assert fd._detect(big, 0, True, crop=False) == (None, None)
+
+
+def test_exceptions_pickle():
+    e = pickle.loads(pickle.dumps(fd.InvalidImage(RuntimeError("bad"))))
+    assert isinstance(e, fd.InvalidImage)
+    assert isinstance(e.error, RuntimeError)
+    assert e.args == ("bad",)
+    e = pickle.loads(pickle.dumps(fd.TooLarge(np.ndarray((2048, 1024, 3)))))
+    assert isinstance(e, fd.TooLarge)
+    assert e.dims == (2048, 1024)
+    assert e.msg == "Image is too large: (2048, 1024)"
 
 
 @patch("bighead.face_detection._load_from_data", return_value=sentinel.DATA)
@@ -47,8 +95,16 @@ def test_load_image(load_from_url, load_from_path, load_from_data):
     load_from_path.assert_called_with("foo")
     assert fd._load_image(url="http://example.com") is sentinel.URL
     load_from_url.assert_called_with("http://example.com")
-    img = np.random.randn(4, 4, 3)
+    img = np.zeros((4, 4, 3), np.uint8)
     assert fd._load_image(image=img) is img
+    with pytest.raises(fd.InvalidImage):
+        fd._load_image(image=np.array([[[0.5, -1.0, 300.0]]]))
+    with pytest.raises(fd.InvalidImage):
+        fd._load_image(image=np.zeros((4, 4, 3), np.uint16))
+    img = np.zeros((4, 8, 3), np.uint8)[:, ::2]
+    loaded = fd._load_image(image=img)
+    assert loaded.flags["C_CONTIGUOUS"]
+    assert np.array_equal(loaded, img)
     with pytest.raises(ValueError):
         fd._load_image()
 
@@ -58,11 +114,15 @@ def _one_image_assertions(image):
     assert image.shape == (430, 800, 3)
 
 
-def test_load_from_data():
+def test_load_from_data(monkeypatch):
     image = fd._load_from_data(ONE_BYTES)
     _one_image_assertions(image)
+    assert image.flags.writeable
     with pytest.raises(fd.InvalidImage):
         fd._load_from_data(b"bad bad bad")
+    monkeypatch.setattr(fd.Image, "MAX_IMAGE_PIXELS", 1000)
+    with pytest.raises(fd.InvalidImage):
+        fd._load_from_data(ONE_BYTES)
 
 
 def test_load_from_path(tmp_path):
@@ -77,17 +137,52 @@ def test_load_from_path(tmp_path):
         fd._load_from_path(str(path))
 
 
-def test_load_from_url():
-    with patch("requests.get") as get, pytest.raises(fd.HTTPError):
+def test_load_from_url(monkeypatch):
+    monkeypatch.setattr(fd, "_URL_CACHE", OrderedDict())
+    with patch.object(fd._SESSION, "get") as get, pytest.raises(fd.HTTPError):
         get.return_value.raise_for_status.side_effect = fd.HTTPError()
         fd._load_from_url("http://example.com")
-    with patch("requests.get") as get:
+    with patch.object(fd._SESSION, "get") as get:
         get.return_value.configure_mock(
             content=ONE_BYTES, raise_for_status=lambda: None
         )
         image = fd._load_from_url("http://example.com")
         _one_image_assertions(image)
-        get.assert_called_with("http://example.com")
+        get.assert_called_with("http://example.com", timeout=fd._TIMEOUT)
+        assert not image.flags.writeable
+        assert fd._load_from_url("http://example.com") is image
+        assert get.call_count == 1
+        image = fd._load_from_url("http://example.com?no-cache")
+        _one_image_assertions(image)
+        assert image.flags.writeable
+        assert fd._load_from_url("http://example.com?no-cache") is not image
+        assert get.call_count == 3
+    with open(BIG_PATH, "rb") as f:
+        big_bytes = f.read()
+    with patch.object(fd._SESSION, "get") as get:
+        get.return_value.configure_mock(
+            content=big_bytes, raise_for_status=lambda: None
+        )
+        image = fd._load_from_url("http://example.com/big")
+        assert image.flags.writeable
+        fd._load_from_url("http://example.com/big")
+        assert get.call_count == 2
+    assert list(fd._URL_CACHE) == ["http://example.com"]
+
+
+def test_cache_image(monkeypatch):
+    monkeypatch.setattr(fd, "_URL_CACHE", OrderedDict())
+    monkeypatch.setattr(fd, "_URL_CACHE_BYTES", 160)
+    a = np.zeros((5, 5, 3), np.uint8)
+    b = np.zeros((5, 5, 3), np.uint8)
+    c = np.zeros((5, 5, 3), np.uint8)
+    fd._cache_image("a", a)
+    assert not a.flags.writeable
+    fd._cache_image("b", b)
+    assert list(fd._URL_CACHE) == ["a", "b"]
+    # 75 bytes each, so only two fit.
+    fd._cache_image("c", c)
+    assert list(fd._URL_CACHE) == ["b", "c"]
 
 
 def test_is_too_large():
@@ -110,9 +205,73 @@ def test_get_bounding_box(FACE_DETECTOR):
     assert fd._get_bounding_box(image, 1) is None
 
 
+def test_get_bounding_box_small_image():
+    # dlib pads its 80x80 window, so faces are still found in smaller images.
+    strip = fd._load_from_path(ONE_PATH)[66:145]
+    assert strip.shape[0] == 79
+    box = fd._get_bounding_box(strip, 0)
+    assert isinstance(box, dlib.rectangle)
+    assert box.left() > 300
+
+
+@patch("bighead.face_detection._USE_CNN", True)
+@patch("bighead.face_detection._FACE_DETECTOR")
+def test_get_bounding_box_cnn(FACE_DETECTOR):
+    FACE_DETECTOR.return_value = [
+        Mock(rect=dlib.rectangle(1, 1, 3, 3), confidence=1.5),
+        Mock(rect=dlib.rectangle(1, 1, 4, 4), confidence=0.5),
+    ]
+    image = np.random.randn(4, 4, 3)
+    assert fd._get_bounding_box(image, 0) == dlib.rectangle(1, 1, 4, 4)
+
+
+def test_get_downscaled_bounding_box():
+    image = fd._load_from_path(ONE_PATH)
+    box = fd._get_bounding_box(image, 0)
+    big = np.repeat(np.repeat(image, 2, axis=0), 2, axis=1)
+    assert fd._is_too_large(big)
+    big_box = fd._get_downscaled_bounding_box(big, 0)
+    assert isinstance(big_box, dlib.rectangle)
+    # Detections vary slightly across scales, so just check that it's the same face.
+    center = box.center()
+    assert big_box.contains(dlib.point(2 * center.x, 2 * center.y))
+    blank = np.zeros((2048, 2048, 3), np.uint8)
+    assert fd._get_downscaled_bounding_box(blank, 0) is None
+    sliver = np.zeros((2_000_000, 1, 3), np.uint8)
+    assert fd._get_downscaled_bounding_box(sliver, 0) is None
+    # This shrinks to 1x591206, so x and y are scaled by 3 and ~1.69 respectively.
+    sliver = np.zeros((1_000_000, 3, 3), np.uint8)
+    with patch("bighead.face_detection._get_bounding_box") as get_bounding_box:
+        get_bounding_box.return_value = dlib.rectangle(0, 0, 1, 100)
+        box = fd._get_downscaled_bounding_box(sliver, 0)
+        assert get_bounding_box.call_args[0][0].shape == (591206, 1, 3)
+    assert box == dlib.rectangle(0, 0, 3, 169)
+
+
+@patch("bighead.face_detection._FACE_DETECTOR")
+def test_warm_up(FACE_DETECTOR, monkeypatch):
+    monkeypatch.delenv("BIGHEAD_WARMUP_URL", raising=False)
+    with patch.object(fd._SESSION, "head") as head:
+        fd._warm_up()
+        FACE_DETECTOR.assert_called_once()
+        head.assert_not_called()
+    monkeypatch.setenv("BIGHEAD_WARMUP_URL", "http://example.com")
+    with patch.object(fd._SESSION, "head") as head:
+        fd._warm_up()
+        head.assert_called_with("http://example.com", timeout=fd._TIMEOUT)
+        head.side_effect = requests.ConnectionError()
+        fd._warm_up()
+
+
 def test_crop():
     image = np.reshape(range(48), (4, 4, 3))
     rect = dlib.rectangle(2, 2, 4, 4)
     face = fd._crop(image, rect)
     assert isinstance(face, np.ndarray)
     assert face.shape == (2, 2, 3)
+    rect = dlib.rectangle(-1, -1, 2, 2)
+    face = fd._crop(image, rect)
+    assert face.shape == (2, 2, 3)
+    assert np.array_equal(face, image[:2, :2])
+    rect = dlib.rectangle(2, 2, 6, 6)
+    assert fd._crop(image, rect).shape == (2, 2, 3)
@@ -1,4 +1,11 @@
-from unittest.mock import Mock
+import os
+import struct
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from unittest.mock import Mock, sentinel
 
 import dlib
 import numpy as np
@@ -8,6 +15,19 @@ from requests import codes
 
 from bighead import web
 
+ONE_PATH = os.path.join(os.path.dirname(__file__), "images", "one.jpg")
+
+
+def _png_header(width, height):
+    """Build a PNG that declares the given size but contains no pixel data."""
+
+    def chunk(kind, data):
+        crc = struct.pack(">I", zlib.crc32(kind + data))
+        return struct.pack(">I", len(data)) + kind + data + crc
+
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IEND", b"")
+
 
 @pytest.fixture
 def client():
@@ -41,11 +61,27 @@ def test_method_not_allowed(client):
     assert resp.json.get("error") == "Method not allowed"
 
 
+def test_request_entity_too_large(client, monkeypatch):
+    monkeypatch.setitem(web.app.config, "MAX_CONTENT_LENGTH", 4)
+    resp = client.post(
+        "/detect_largest_face", data=b"hello", headers={"Content-Type": "image/png"}
+    )
+    assert resp.status_code == codes.request_entity_too_large
+    assert resp.is_json
+    assert resp.json.get("error") == "Request data is too large"
+
+
 def test_detect_largest_face(client, monkeypatch):
     resp = client.post(
         "/detect_largest_face", data=b"bad", headers={"Content-Type": "image/png"}
     )
     assert resp.status_code == codes.unprocessable
+    resp = client.post(
+        "/detect_largest_face",
+        data=_png_header(20000, 20000),
+        headers={"Content-Type": "image/png"},
+    )
+    assert resp.status_code == codes.unprocessable
     monkeypatch.setattr(
         web, "_preprocess_request", Mock(side_effect=[(b"hi", 1), ValueError("ah")])
     )
@@ -59,7 +95,7 @@ def test_detect_largest_face(client, monkeypatch):
     assert resp.status_code == codes.bad
 
 
-def test_preprocess_request(client):
+def test_preprocess_request(client, monkeypatch):
     with web.app.test_request_context("/detect_largest_face", data=b""), pytest.raises(
         ValueError
     ):
@@ -74,6 +110,37 @@ def test_preprocess_request(client):
         web._preprocess_request()
     with web.app.test_request_context("/detect_largest_face?upsample=2", data=b"hi"):
         assert web._preprocess_request() == (b"hi", 2)
+    monkeypatch.setitem(web.app.config, "MAX_CONTENT_LENGTH", 1)
+    with web.app.test_request_context(
+        "/detect_largest_face", data=b"hi"
+    ), pytest.raises(web.RequestEntityTooLarge):
+        web._preprocess_request()
+
+
+def _chunked_request_context(data):
+    """Build a request context for a chunked upload, which has no Content-Length."""
+    return web.app.test_request_context(
+        "/detect_largest_face?upsample=1",
+        input_stream=BytesIO(data),
+        headers={"Transfer-Encoding": "chunked"},
+        environ_overrides={"wsgi.input_terminated": True},
+    )
+
+
+def test_preprocess_request_chunked(monkeypatch):
+    with open(ONE_PATH, "rb") as f:
+        data = f.read()
+    with _chunked_request_context(data):
+        assert web.request.content_length is None
+        assert web._preprocess_request() == (data, 1)
+    with _chunked_request_context(b""), pytest.raises(ValueError):
+        web._preprocess_request()
+    monkeypatch.setitem(web.app.config, "MAX_CONTENT_LENGTH", len(data))
+    with _chunked_request_context(data):
+        assert web._preprocess_request() == (data, 1)
+    monkeypatch.setitem(web.app.config, "MAX_CONTENT_LENGTH", len(data) - 1)
+    with _chunked_request_context(data), pytest.raises(web.RequestEntityTooLarge):
+        web._preprocess_request()
 
 
 def test_error():
@@ -93,6 +160,8 @@ def test_success():
 
 
 def test_detect(monkeypatch):
+    # Mocks can't be sent to other processes.
+    monkeypatch.setattr(web, "_POOL", ThreadPoolExecutor(max_workers=1))
     monkeypatch.setattr(
         web,
         "find_biggest_face",
@@ -119,3 +188,34 @@ def test_detect(monkeypatch):
         {"error": "Image is too large: (4, 4)"},
         codes.request_entity_too_large,
     )
+
+
+def test_detect_broken_pool(monkeypatch):
+    broken = ProcessPoolExecutor(max_workers=1)
+    with pytest.raises(BrokenProcessPool):
+        broken.submit(os._exit, 1).result()
+    monkeypatch.setattr(web, "_POOL", broken)
+    with open(ONE_PATH, "rb") as f:
+        data = f.read()
+    assert web._detect(data, 0) == (
+        {"error": "Face detection failed"},
+        codes.server_error,
+    )
+    assert web._POOL is not broken
+    resp, status = web._detect(data, 0)
+    assert status == codes.ok
+    assert "box" in resp
+    web._POOL.shutdown()
+
+
+def test_restart_pool(monkeypatch):
+    pool = Mock()
+    monkeypatch.setattr(web, "_POOL", pool)
+    monkeypatch.setattr(web, "create_executor", Mock(return_value=sentinel.POOL))
+    web._restart_pool(pool)
+    assert web._POOL is sentinel.POOL
+    pool.shutdown.assert_called_once_with(wait=False)
+    # Already replaced by another request.
+    web._restart_pool(pool)
+    assert web._POOL is sentinel.POOL
+    web.create_executor.assert_called_once()